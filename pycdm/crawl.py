@@ -0,0 +1,169 @@
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import time
+
+from ldp import LDPReader, NonRDFSource
+
+# Crawl a repository with many worker processes, possibly on many hosts,
+# that share a SQLite work queue. The queue records every URI ever
+# discovered, so it also does the de-duplication, and leases that are
+# not completed within timeout seconds are handed out again.
+# NB SQLite locking is unreliable on some network filesystems
+
+class CrawlQueue(object):
+
+	def __init__(self, filename, timeout=300, max_attempts=3):
+		self.filename = filename
+		self.timeout = timeout
+		self.max_attempts = max_attempts
+		self.conn = sqlite3.connect(filename, timeout=60, isolation_level=None)
+		self.conn.execute("PRAGMA journal_mode=WAL")
+		self.conn.execute("CREATE TABLE IF NOT EXISTS queue (uri TEXT PRIMARY KEY, "
+			"state TEXT, worker TEXT, leased REAL, attempts INTEGER DEFAULT 0)")
+		self.conn.execute("CREATE INDEX IF NOT EXISTS queue_state ON queue (state)")
+		self.conn.execute("CREATE TABLE IF NOT EXISTS results (uri TEXT PRIMARY KEY, "
+			"type TEXT, etag TEXT, json TEXT, worker TEXT)")
+
+	def close(self):
+		self.conn.close()
+
+	def add(self, uris):
+		self.conn.executemany("INSERT OR IGNORE INTO queue (uri, state) VALUES (?, 'pending')",
+			[(u,) for u in uris])
+
+	def lease(self, worker, count=10):
+		now = time.time()
+		c = self.conn
+		c.execute("BEGIN IMMEDIATE")
+		try:
+			# Recover from crashed workers
+			c.execute("UPDATE queue SET state='pending' WHERE state='leased' AND leased < ?",
+				(now - self.timeout,))
+			uris = [r[0] for r in c.execute("SELECT uri FROM queue WHERE state='pending' LIMIT ?",
+				(count,))]
+			c.executemany("UPDATE queue SET state='leased', worker=?, leased=? WHERE uri=?",
+				[(worker, now, u) for u in uris])
+			c.execute("COMMIT")
+		except:
+			c.execute("ROLLBACK")
+			raise
+		return uris
+
+	def complete(self, results, children, worker):
+		# results is a list of (uri, type, etag, json)
+		c = self.conn
+		c.execute("BEGIN IMMEDIATE")
+		try:
+			c.executemany("INSERT OR IGNORE INTO queue (uri, state) VALUES (?, 'pending')",
+				[(u,) for u in children])
+			c.executemany("INSERT OR REPLACE INTO results (uri, type, etag, json, worker) "
+				"VALUES (?, ?, ?, ?, ?)", [r + (worker,) for r in results])
+			c.executemany("INSERT OR REPLACE INTO queue (uri, state, worker) VALUES (?, 'done', ?)",
+				[(r[0], worker) for r in results])
+			c.execute("COMMIT")
+		except:
+			c.execute("ROLLBACK")
+			raise
+
+	def fail(self, uri):
+		self.conn.execute("UPDATE queue SET attempts=attempts+1, "
+			"state=CASE WHEN attempts+1 >= ? THEN 'failed' ELSE 'pending' END WHERE uri=?",
+			(self.max_attempts, uri))
+
+	def counts(self):
+		return dict(self.conn.execute("SELECT state, COUNT(*) FROM queue GROUP BY state").fetchall())
+
+	def is_finished(self):
+		counts = self.counts()
+		return not counts.get('pending') and not counts.get('leased')
+
+	def export(self, fh):
+		# Results as one JSON record per line
+		for (uri, typ, etag, js) in self.conn.execute("SELECT uri, type, etag, json FROM results"):
+			fh.write(json.dumps({'uri': uri, 'type': typ, 'etag': etag, 'json': json.loads(js)}) + "\n")
+
+
+def get_result(reader, what):
+	if isinstance(what, NonRDFSource):
+		js = what.describedby.json if what.describedby else {}
+	else:
+		js = what.json
+	return (what.uri, what._type, what.etag, json.dumps(js))
+
+def get_children(reader, what):
+	contains = getattr(what, 'contains', [])
+	if type(contains) != list:
+		contains = [contains]
+	return [reader.get_uri(c) for c in contains]
+
+def crawl_worker(queuefile, context, reader_class=LDPReader, worker="", batch=10, idle=5, timeout=300):
+	reader = reader_class(context)
+	queue = CrawlQueue(queuefile, timeout=timeout)
+	if not worker:
+		worker = "%s:%s" % (socket.gethostname(), os.getpid())
+
+	while True:
+		uris = queue.lease(worker, batch)
+		if not uris:
+			if queue.is_finished():
+				break
+			# others may still discover more
+			time.sleep(idle)
+			continue
+
+		failed = set()
+		for uri in uris:
+			try:
+				reader.retrieve(uri)
+			except Exception:
+				queue.fail(uri)
+				failed.add(uri)
+
+		# Everything retrieved along the way, eg by build_from_rdf, is
+		# recorded too so it isn't fetched again by another worker
+		results = []
+		children = []
+		for what in reader.object_map.values():
+			if what.uri in failed:
+				continue
+			results.append(get_result(reader, what))
+			children.extend(get_children(reader, what))
+		queue.complete(results, children, worker)
+
+		# The queue is the record of what has been seen, so start afresh
+		reader.object_map.clear()
+		if reader.index is not None:
+			reader.index = reader.index.__class__(reader)
+
+	queue.close()
+
+
+class CrawlCoordinator(object):
+
+	def __init__(self, queuefile, context, reader_class=LDPReader, workers=4, timeout=300):
+		self.queuefile = queuefile
+		self.context = context
+		self.reader_class = reader_class
+		self.workers = workers
+		self.timeout = timeout
+		self.queue = CrawlQueue(queuefile, timeout=timeout)
+
+	def seed(self, uri):
+		self.queue.add([uri])
+
+	def run(self):
+		# Local worker processes; workers on other hosts just call
+		# crawl_worker() with the same queue file
+		procs = []
+		for x in range(self.workers):
+			p = multiprocessing.Process(target=crawl_worker,
+				args=(self.queuefile, self.context, self.reader_class),
+				kwargs={'timeout': self.timeout})
+			p.start()
+			procs.append(p)
+		for p in procs:
+			p.join()
+		return self.queue.counts()
@@ -0,0 +1,103 @@
+import os
+import sqlite3
+
+from ldp import get_remote_digests
+
+# Content addressed uploads
+# Binaries are identified by digest, and content that the repository
+# already holds is linked to (or skipped) rather than transferred again
+
+class ContentIndex(object):
+	# Local record of digest -> uri of binaries we have uploaded
+
+	def __init__(self, filename):
+		self.conn = sqlite3.connect(filename)
+		self.conn.execute("CREATE TABLE IF NOT EXISTS content (digest TEXT PRIMARY KEY, "
+			"uri TEXT, size INTEGER)")
+		self.conn.commit()
+
+	def close(self):
+		self.conn.close()
+
+	def get(self, digest):
+		row = self.conn.execute("SELECT uri FROM content WHERE digest=?", (digest,)).fetchone()
+		return row[0] if row else None
+
+	def add(self, digest, uri, size):
+		self.conn.execute("INSERT OR REPLACE INTO content (digest, uri, size) VALUES (?, ?, ?)",
+			(digest, uri, size))
+		self.conn.commit()
+
+	def remove(self, digest):
+		self.conn.execute("DELETE FROM content WHERE digest=?", (digest,))
+		self.conn.commit()
+
+
+class DedupingUploader(object):
+	algorithm = 'sha1'
+
+	def __init__(self, index, link=True):
+		# Content already at the same place is always skipped
+		# link: content found elsewhere is created as a message/external-body
+		# link to the existing binary, otherwise it is uploaded again
+		if type(index) in [str, unicode]:
+			index = ContentIndex(index)
+		self.index = index
+		self.link = link
+		self.stats = {'files': 0, 'uploaded': 0, 'linked': 0, 'skipped': 0,
+			'bytes_uploaded': 0, 'bytes_saved': 0}
+
+	def get_digest(self, what):
+		if not self.algorithm in what.digest_algorithms:
+			what.digest_algorithms = list(what.digest_algorithms) + [self.algorithm]
+		return what.compute_digests()[self.algorithm]
+
+	def find_existing(self, digest):
+		# Check the index entry is still in the repository with that content
+		uri = self.index.get(digest)
+		if not uri:
+			return None
+		remote = get_remote_digests(uri, self.algorithm)
+		if remote.get(self.algorithm) != digest:
+			self.index.remove(digest)
+			return None
+		return uri
+
+	def get_target(self, container, what):
+		# Where what will end up, if it has a slug
+		if container is None or not container.uri or not what.slug:
+			return None
+		return os.path.join(container.uri, what.slug)
+
+	def upload(self, what, create, container=None):
+		# create is the callable that would normally upload what into container
+		digest = self.get_digest(what)
+		size = len(what.data)
+		self.stats['files'] += 1
+		existing = self.find_existing(digest)
+		# Only skip if it's the same resource, as a new parent would
+		# otherwise lose its hasFile
+		if existing and existing == self.get_target(container, what):
+			what.uri = existing
+			self.stats['skipped'] += 1
+			self.stats['bytes_saved'] += size
+		elif existing and self.link:
+			what.external_url = existing
+			create(what)
+			self.stats['linked'] += 1
+			self.stats['bytes_saved'] += size
+		else:
+			create(what)
+			self.index.add(digest, what.uri, size)
+			self.stats['uploaded'] += 1
+			self.stats['bytes_uploaded'] += size
+		return what
+
+	def add_file(self, obj, what):
+		return self.upload(what, obj.add_file, obj.filesContainer)
+
+	def create_child(self, container, what):
+		return self.upload(what, container.create_child, container)
+
+	def report(self):
+		return dict(self.stats)
@@ -1,6 +1,11 @@
+import hashlib
 import json
+import multiprocessing
 import os
 import re
+import threading
+from collections import deque
+from multiprocessing.pool import ThreadPool
 
 try:
 	from collections import OrderedDict
@@ -10,12 +15,300 @@ except:
 import requests
 from pyld import jsonld
 
+try:
+	import ijson
+	from ijson.common import ObjectBuilder
+except:
+	# Streaming of large containers is unavailable
+	ijson = None
+
+CHUNK_SIZE = 1024 * 1024
+
+def file_digests(filename, algorithms=('sha1',)):
+	# Returns {algorithm: hexdigest} after a single read of filename
+	hashers = [(a, hashlib.new(a)) for a in algorithms]
+	fh = open(filename, 'rb')
+	while True:
+		chunk = fh.read(CHUNK_SIZE)
+		if not chunk:
+			break
+		for (a, h) in hashers:
+			h.update(chunk)
+	fh.close()
+	return dict([(a, h.hexdigest()) for (a, h) in hashers])
+
+def _file_digests_star(args):
+	# Pool.map only passes a single argument
+	return file_digests(*args)
+
+def digest_files(filenames, algorithms=('sha1',), processes=None):
+	# Hash a batch of files in a process pool, {filename: {algorithm: hex}}
+	# The results can be given to NonRDFSource(digests=...)
+	pool = multiprocessing.Pool(processes)
+	try:
+		results = pool.map(_file_digests_star, [(f, algorithms) for f in filenames])
+	finally:
+		pool.close()
+		pool.join()
+	return dict(zip(filenames, results))
+
+def etag_digests(etag):
+	# Fedora's binary ETag is the SHA-1 of the content
+	tag = etag.replace('W/', '').strip('"')
+	if re.match("^[0-9a-fA-F]{40}$", tag):
+		return {'sha1': tag.lower()}
+	return {}
+
+def get_remote_digests(uri, algorithm='sha1'):
+	# Digests the repository holds for a binary, {} if it doesn't exist
+	req = requests.head(url=uri, headers={'Want-Digest': algorithm})
+	if req.status_code in [404, 410]:
+		return {}
+	req.raise_for_status()
+	remote = parse_digest_header(req.headers.get('digest', ''))
+	return remote or etag_digests(req.headers.get('etag', ''))
+
+def parse_digest_header(value):
+	# Digest: sha1=abc..., sha256=... -> {algorithm: hexdigest}
+	# Accepts Fedora's hex encoding as well as RFC 3230 base64
+	digests = {}
+	for d in value.split(','):
+		if not '=' in d:
+			continue
+		alg, val = d.strip().split('=', 1)
+		alg = alg.lower().replace('-', '')
+		if alg == 'sha':
+			alg = 'sha1'
+		try:
+			size = hashlib.new(alg).digest_size
+		except ValueError:
+			continue
+		if len(val) != size * 2:
+			val = val.decode('base64').encode('hex')
+		digests[alg] = val.lower()
+	return digests
+
+def compact_jsonld(js, uri, context, id_alias=""):
+	if type(js) == list:
+		# find actual object
+		# NB for fcr:metadata it's not retrieved URI
+		for o in js:
+			if o['@id'] == uri or (id_alias and o.get(id_alias, '') == uri):
+				js = o
+				break
+
+	js = jsonld.compact(js, context)
+	del js['@context']
+	return js
+
+LDP_NS = "http://www.w3.org/ns/ldp#"
+LDP_CONTAINMENT = "http://www.w3.org/ns/ldp#PreferContainment"
+LDP_MEMBERSHIP = "http://www.w3.org/ns/ldp#PreferMembership"
+
+LDP_CONTAINS = ["http://www.w3.org/ns/ldp#contains", "ldp:contains", "contains"]
+LDP_CONTAINER_TYPES = ["http://www.w3.org/ns/ldp#%s" % x for x in
+	["Container", "BasicContainer", "DirectContainer", "IndirectContainer"]]
+
+def _stream_number(value):
+	# ijson gives Decimals, which don't survive compaction
+	if type(value).__name__ == 'Decimal':
+		return int(value) if value == value.to_integral_value() else float(value)
+	return value
+
+def stream_jsonld(fh, uri, id_alias=""):
+	# Incrementally parse an expanded JSON-LD document from fh, keeping
+	# only the node for uri. Its containment is returned separately as a
+	# list of URIs, so neither the document nor the containment nodes are
+	# ever held in memory
+	target = None
+	contains = []
+	builder = None
+	for prefix, event, value in ijson.parse(fh):
+		if builder is None:
+			if event == 'start_map' and prefix in ['item', '@graph.item']:
+				base = prefix
+				builder = ObjectBuilder()
+				builder.event(event, value)
+				kids = []
+				skip = None
+			continue
+
+		if skip is not None:
+			if prefix == skip or prefix.startswith(skip + '.'):
+				if event == 'string' and prefix in [skip + '.item', skip + '.item.@id']:
+					kids.append(value)
+				continue
+			skip = None
+
+		if event == 'map_key' and prefix == base and value in LDP_CONTAINS:
+			skip = "%s.%s" % (base, value)
+			continue
+
+		builder.event(event, _stream_number(value))
+		if event == 'end_map' and prefix == base:
+			node = builder.value
+			builder = None
+			if node.get('@id') == uri or (id_alias and node.get(id_alias) == uri):
+				target = node
+				contains = kids
+	return (target, contains)
+
+RDF_TYPE = "http://www.w3.org/1999/02/22-rdf-syntax-ns#type"
+XSD_STRING = "http://www.w3.org/2001/XMLSchema#string"
+NT_TRIPLE = re.compile(r'^(<[^>]*>|_:\S+)\s+<([^>]*)>\s+(.+?)\s*\.\s*$')
+NT_LITERAL = re.compile(r'^"(.*)"(?:@([a-zA-Z][a-zA-Z0-9-]*)|\^\^<([^>]*)>)?$')
+NT_ESCAPE = re.compile(r'\\(u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|[tbnrf"\'\\])')
+NT_CHARS = {'t': u'\t', 'b': u'\b', 'n': u'\n', 'r': u'\r', 'f': u'\f'}
+
+def _nt_unescape(m):
+	c = m.group(1)
+	if c[0] in 'uU':
+		return ('\\U%08x' % int(c[1:], 16)).decode('unicode-escape')
+	return NT_CHARS.get(c, c)
+
+def _nt_value(obj, coerce, context):
+	# Returns (value, compatible with a term coerced to coerce)
+	if obj[0] == '<':
+		iri = obj[1:-1]
+		if coerce == '@id':
+			return (context.compact_iri(iri, vocab=False), True)
+		return ({context.id_alias or '@id': context.compact_iri(iri, vocab=False)}, not coerce)
+	elif obj[0] == '_':
+		return ({context.id_alias or '@id': obj}, not coerce)
+	m = NT_LITERAL.match(obj)
+	if not m:
+		raise ValueError("Could not parse N-Triples object: %s" % obj)
+	value, lang, dt = m.groups()
+	value = NT_ESCAPE.sub(_nt_unescape, value)
+	if lang:
+		return ({'@value': value, '@language': lang}, not coerce)
+	elif dt and dt != XSD_STRING:
+		if coerce == dt:
+			return (value, True)
+		return ({'@value': value, '@type': context.compact_iri(dt)}, not coerce)
+	return (value, not coerce)
+
+def parse_ntriples(lines, uri, context):
+	# Line oriented N-Triples parse straight to the compacted form that
+	# clean_jsonld would produce for the node uri
+	target = u"<%s>" % uri
+	props = OrderedDict()
+	for line in lines:
+		if type(line) != unicode:
+			line = line.decode('utf-8')
+		if not line.startswith(target):
+			continue
+		m = NT_TRIPLE.match(line)
+		if m:
+			props.setdefault(m.group(2), []).append(m.group(3))
+
+	terms = context.get_terms()
+	js = {context.id_alias or '@id': uri}
+	for (pred, objs) in props.items():
+		if pred == RDF_TYPE:
+			key = context.type_alias or '@type'
+			js[key] = [context.compact_iri(o[1:-1]) for o in objs if o[0] == '<']
+			continue
+		term, coerce = terms.get(pred, (None, None))
+		for o in objs:
+			value, ok = _nt_value(o, coerce, context)
+			if term and ok:
+				key = term
+			else:
+				# no term that fits, so a compact IRI
+				key = context.compact_iri(pred, vocab=False)
+				if not ok:
+					value, ok = _nt_value(o, None, context)
+			js.setdefault(key, []).append(value)
+
+	for (k, v) in js.items():
+		if type(v) == list and len(v) == 1:
+			js[k] = v[0]
+	return js
+
+# Context for JSON-LD worker processes, set once per worker
+_worker_context = {}
+
+def _init_jsonld_worker(context, id_alias):
+	_worker_context['context'] = context
+	_worker_context['id_alias'] = id_alias
+
+def _parse_jsonld(data, uri):
+	return compact_jsonld(json.loads(data), uri, _worker_context['context'],
+		_worker_context['id_alias'])
+
+def parse_link_header(value):
+	# XXX Replace with real link header parser
+	links = value.split(', ')
+	ldict = {}
+	lre = re.compile("<(.+)>;\s*rel\s*=\s*\"(.+)\"")
+	for l in links:
+		m = lre.match(l)
+		if m:
+			uri, t = m.groups()
+			try:
+				ldict[t].append(uri)
+			except:
+				ldict[t] = [uri]					
+	return ldict
+
+class Prefetcher(object):
+	# Iterate (item, func(item)) in order, with func running in the
+	# background for up to size items ahead of the consumer.
+	# When the consumer stops, queued work is dropped and close is
+	# called on results that were never consumed
+
+	def __init__(self, func, items, size=4, close=None):
+		self.func = func
+		self.items = items
+		self.size = size
+		self.close = close
+
+	def __iter__(self):
+		pool = ThreadPool(self.size)
+		cancelled = threading.Event()
+		def run(item):
+			if cancelled.is_set():
+				return None
+			result = self.func(item)
+			if cancelled.is_set() and self.close is not None and result is not None:
+				self.close(result)
+				return None
+			return result
+
+		items = iter(self.items)
+		window = deque()
+		def fill():
+			while len(window) < self.size:
+				try:
+					item = items.next()
+				except StopIteration:
+					return
+				window.append((item, pool.apply_async(run, (item,))))
+
+		try:
+			fill()
+			while window:
+				item, res = window.popleft()
+				fill()
+				yield (item, res.get())
+		finally:
+			cancelled.set()
+			# queued work returns at once, wait for anything running
+			pool.close()
+			pool.join()
+			if self.close is not None:
+				for (item, res) in window:
+					if res.successful() and res.get() is not None:
+						self.close(res.get())
+
 class LDPResource(object):
 	uri = ""
 	slug = ""
 	data = ""
 	link_header = ""
 	etag = ""
+	lastModified = ""
 	contentType = ""
 	container = None
 
@@ -30,28 +323,22 @@ class LDPResource(object):
 		self.link_header = ""
 		self.links = {}
 		self.etag = ""
+		self.lastModified = ""
 		self.contentType = ""
 		self.container = container		
 
 	def http_setup(self, req, reader=None, target=None):
-		self.data = req.content
+		self.data = reader.get_body(req) if reader else req.content
 		self.etag = req.headers.get('etag', '')
+		self.lastModified = req.headers.get('last-modified', '')
 		self.link_header = req.headers.get('link', '')
 		self.contentType = req.headers.get('content-type', '')
 
-		# XXX Replace with real link header parser
-		links = self.link_header.split(', ')
-		ldict = {}
-		lre = re.compile("<(.+)>;\s*rel\s*=\s*\"(.+)\"")
-		for l in links:
-			m = lre.match(l)
-			if m:
-				uri, t = m.groups()
-				try:
-					ldict[t].append(uri)
-				except:
-					ldict[t] = [uri]					
-		self.links = ldict
+		self.links = parse_link_header(self.link_header)
+
+	def get_link_types(self):
+		# rel="type" from the Link header, available without the body
+		return self.links.get('type', [])
 
 	def read(self, filename):
 		# Read content in from disk
@@ -65,6 +352,13 @@ class LDPResource(object):
 		self.data = fh.read()
 		fh.close()
 
+	def content_headers(self):
+		# Extra headers to send along with our representation
+		return {}
+
+	def get_body(self):
+		return self.data
+
 	def update_etag(self):	
 		hdrs = {'Accept': self.contentType}		
 		req = requests.head(url=self.uri, headers=hdrs)
@@ -76,8 +370,9 @@ class LDPResource(object):
 		hdrs = {'Content-Type': self.contentType}
 		if self.slug:
 			hdrs['Slug'] = self.slug
+		hdrs.update(self.content_headers())
 
-		req = requests.post(url=self.container.uri, data=self.data, headers=hdrs)
+		req = requests.post(url=self.container.uri, data=self.get_body(), headers=hdrs)
 		req.raise_for_status()
 
 		status = req.status_code
@@ -91,7 +386,8 @@ class LDPResource(object):
 		hdrs = {'Content-Type': self.contentType}
 		if self.etag:
 			hdrs['If-Match'] = self.etag
-		req = requests.put(url=self.uri, data=self.data, headers=hdrs)
+		hdrs.update(self.content_headers())
+		req = requests.put(url=self.uri, data=self.get_body(), headers=hdrs)
 		req.raise_for_status()		
 
 		self.etag = req.headers.get('etag', '')
@@ -117,16 +413,148 @@ class LDPResource(object):
 class NonRDFSource(LDPResource):
 	_type = "ldp:NonRDFSource"
 	describedby = None
+	# Fixity digests to send for server-side verification, eg ['sha1', 'sha256']
+	digest_algorithms = []
+	digests = {}
+	# If set, create a link to this URL instead of uploading data
+	external_url = ""
 
-	def __init__(self, uri="", slug="", filename="", data=""):
+	def __init__(self, uri="", slug="", filename="", data="", digest_algorithms=None, digests=None):
 		super(NonRDFSource, self).__init__(uri, slug)		
 		self.describedby = None
+		if digest_algorithms is not None:
+			self.digest_algorithms = digest_algorithms
+		# algorithm to hexdigest, may be precomputed via digest_files()
+		self.digests = dict(digests) if digests else {}
+		self.external_url = ""
 		if not uri:
 			if data:
 				self.data = data
 			elif filename:
 				self.read(filename)
 
+	def read(self, filename):
+		# Compute digests as soon as it is read, so content is only read once
+		if type(filename) in [str, unicode]:
+			fh = file(filename, 'rb')
+		elif filename.read:
+			fh = filename
+		else:
+			raise ValueError()
+		self.data = fh.read()
+		fh.close()
+		hashers = [(a, hashlib.new(a)) for a in self.digest_algorithms if not self.digests.has_key(a)]
+		# slices of the one copy, rather than chunks joined into a second
+		for off in range(0, len(self.data), CHUNK_SIZE):
+			for (a, h) in hashers:
+				h.update(buffer(self.data, off, CHUNK_SIZE))
+		for (a, h) in hashers:
+			self.digests[a] = h.hexdigest()
+
+	def compute_digests(self):
+		for a in self.digest_algorithms:
+			if not self.digests.has_key(a):
+				self.digests[a] = hashlib.new(a, self.data).hexdigest()
+		return self.digests
+
+	def get_body(self):
+		if self.external_url:
+			return ""
+		return super(NonRDFSource, self).get_body()
+
+	def content_headers(self):
+		hdrs = super(NonRDFSource, self).content_headers()
+		if self.external_url:
+			# Fedora redirects to the content rather than storing it again
+			hdrs['Content-Type'] = 'message/external-body; access-type=URL; URL="%s"' % self.external_url
+		elif self.digest_algorithms:
+			self.compute_digests()
+			# Fedora expects hex encoded values
+			vals = ["%s=%s" % (a, self.digests[a]) for a in self.digest_algorithms]
+			hdrs['Digest'] = ", ".join(vals)
+		return hdrs
+
+	def download(self, filename, chunk_size=8*CHUNK_SIZE, threads=4):
+		# Fetch the binary as concurrent Range requests into filename
+		# Progress is kept in filename.part so a broken download resumes
+		if not self.uri:
+			raise ValueError()
+
+		req = requests.head(url=self.uri, headers={'Want-Digest': 'sha1'})
+		req.raise_for_status()
+		length = int(req.headers['content-length'])
+		etag = req.headers.get('etag', '')
+		remote = parse_digest_header(req.headers.get('digest', ''))
+
+		statefn = filename + ".part"
+		done = set()
+		if os.path.exists(statefn) and os.path.exists(filename):
+			fh = file(statefn)
+			state = json.load(fh)
+			fh.close()
+			if state['etag'] == etag and state['length'] == length \
+					and state['chunk_size'] == chunk_size:
+				done = set(state['done'])
+		if not done:
+			# preallocate, so each range can be written in place
+			fh = open(filename, 'wb')
+			fh.truncate(length)
+			fh.close()
+
+		lock = threading.Lock()
+		def save_state():
+			fh = file(statefn, 'w')
+			json.dump({'etag': etag, 'length': length, 'chunk_size': chunk_size,
+				'done': list(done)}, fh)
+			fh.close()
+
+		def fetch(start):
+			end = min(start + chunk_size, length) - 1
+			hdrs = {'Range': 'bytes=%d-%d' % (start, end)}
+			if etag and not etag.startswith('W/'):
+				# fail rather than mix ranges of two versions
+				hdrs['If-Match'] = etag
+			req = requests.get(url=self.uri, headers=hdrs, stream=True)
+			req.raise_for_status()
+			if req.status_code != 206:
+				raise ValueError("Server did not honour Range request")
+			fh = open(filename, 'r+b')
+			fh.seek(start)
+			for chunk in req.iter_content(CHUNK_SIZE):
+				fh.write(chunk)
+			fh.close()
+			with lock:
+				done.add(start)
+				save_state()
+
+		todo = [x for x in range(0, length, chunk_size) if not x in done]
+		if todo:
+			pool = ThreadPool(threads)
+			try:
+				pool.map(fetch, todo)
+			finally:
+				pool.close()
+				pool.join()
+
+		try:
+			self.verify_download(filename, etag, remote)
+		finally:
+			# a bad copy can't be resumed, so the next attempt starts again
+			if os.path.exists(statefn):
+				os.remove(statefn)
+		self.etag = etag
+		return filename
+
+	def verify_download(self, filename, etag, remote):
+		remote = remote or etag_digests(etag)
+		if not remote:
+			return
+		local = file_digests(filename, remote.keys())
+		for (a, val) in remote.items():
+			if local[a] != val:
+				raise ValueError("%s digest mismatch for %s" % (a, self.uri))
+		self.digests.update(local)
+
 	def http_setup(self, req, reader, target=None):
 		super(NonRDFSource, self).http_setup(req, reader, target)
 		# Now grab our metadata
@@ -136,12 +564,15 @@ class NonRDFSource(LDPResource):
 
 class RDFSource(LDPResource):
 	_type = "ldp:RDFSource"
-	json = {}
+	_json = None
+	# (reader, body, content type, uri) until json is first needed
+	_pending = None
 	context = None
 	_setup = False
 
 	def __init__(self, uri="", slug="", container=None, context=None):
 		super(RDFSource, self).__init__(uri=uri, slug=slug, container=container)
+		self._pending = None
 		self.json = {}
 		self.contentType = 'application/ld+json'
 		self._setup = False
@@ -150,9 +581,9 @@ class RDFSource(LDPResource):
 			self.add_field('@type', self._type)
 
 	def patch_single(self, field, value):
-		if not self.uri:
-			raise ValueError()
+		self.patch_fields([(field, value)])
 
+	def get_triple(self, field, value):
 		if field.find(':') == -1:
 			field = self.context.get_mapping(field)
 
@@ -164,6 +595,15 @@ class RDFSource(LDPResource):
 				# Should be a uri
 				value = '<%s>' % value
 		# otherwise use a raw value and hope it's right
+		return "<> %s %s ." % (field, value)
+
+	def patch_fields(self, pairs, deletes=None):
+		# INSERT several (field, value) pairs, and DELETE deletes, with one PATCH
+		if not self.uri:
+			raise ValueError()
+
+		triples = [self.get_triple(f, v) for (f, v) in pairs]
+		dtriples = [self.get_triple(f, v) for (f, v) in deletes or []]
 
 		hdrs = {'Content-Type': 'application/sparql-update'}
 		if self.etag:
@@ -172,7 +612,9 @@ class RDFSource(LDPResource):
 		# Generate prefixes from context
 		patch = self.context.get_prefixes()
 		patch.append("")
-		patch.append("INSERT {<> %s %s .}" % (field, value))
+		if dtriples:
+			patch.append("DELETE {%s}" % " ".join(dtriples))
+		patch.append("INSERT {%s}" % " ".join(triples))
 		patch.append("WHERE {}")
 		patchstr = "\n".join(patch)
 
@@ -189,11 +631,36 @@ class RDFSource(LDPResource):
 		except:
 			print "Can only handle JSON-LD at the moment"
 
+	def get_json(self):
+		# Parse the retrieved body on first use, then only json is kept
+		if self._pending is not None:
+			reader, body, ct, uri = self._pending
+			self._pending = None
+			self._json = reader.parse_body(body, ct, uri)
+		return self._json
+
+	def set_json(self, value):
+		self._pending = None
+		self._json = value
+
+	json = property(get_json, set_json)
+
 	def http_setup(self, req, reader, target=None):
 		super(RDFSource, self).http_setup(req, reader, target)
-		if self.data and self.contentType.startswith("application/ld+json"):
-			clean_uri = target if target else self.uri
-			self.json = reader.clean_jsonld(req.json(), clean_uri)		
+		clean_uri = target if target else self.uri
+		if reader.is_rdf_type(self.contentType):
+			if reader.has_json(clean_uri):
+				# already parsed to find our class
+				self.json = reader.get_json(req, clean_uri)
+			elif self.data:
+				self._pending = (reader, self.data, self.contentType, clean_uri)
+			# json is what we hold and write, whatever was negotiated
+			self.data = ""
+			self.contentType = 'application/ld+json'
+
+	def get_body(self):
+		# Serialized as sent, rather than kept in data
+		return json.dumps(self.to_jsonld())
 
 	def add_field(self, what, value):
 		# ensure non-duplicates
@@ -241,13 +708,9 @@ class RDFSource(LDPResource):
 
 		if not self._setup:
 			self.setup()
-		js = self.to_jsonld()
 
 		# print json.dumps(self.json, indent=2)		
 
-		jstr = json.dumps(js)
-		
-		self.data  = jstr
 		super(RDFSource, self).create()
 
 	def update(self):
@@ -256,9 +719,6 @@ class RDFSource(LDPResource):
 		elif not self.json:
 			raise ValueError()
 
-		js = self.to_jsonld()
-		jstr = json.dumps(js)
-		self.data = jstr
 		super(RDFSource, self).update()
 
 
@@ -266,17 +726,35 @@ class Container(RDFSource):
 	_type = "ldp:Container"
 	contains = []
 	_contains_map = {}
+	_contains_index = set()
+	# URIs in the order paging found them, once paging has finished
+	_contains_order = []
+	# the next page to fetch, '' before the first
+	_next_page = ''
+	# True if retrieved without containment, see LDPReader.retrieve(minimal=True)
+	paged = False
 
 	def __init__(self, *args, **kw):
 		super(Container, self).__init__(*args, **kw)
 		self.contains = []
 		self._contains_map = {}
+		self._contains_index = set()
+		self._contains_order = []
+		self._next_page = ''
+		self.paged = False
+		self._paged_complete = False
 
 	def build_from_rdf(self, reader):
 		super(Container, self).build_from_rdf(reader)
 		if self.json and self.json.has_key('contains'):
 			# And be ready to replace these with real objects later
 			self.contains = self.json['contains']
+			self._contains_index = set([reader.get_uri(c) for c in self.get_contains_list()])
+
+	def get_contains_list(self):
+		if type(self.contains) == list:
+			return self.contains
+		return [self.contains]
 
 	def create_child(self, what):
 		# Given an LDPResource, create it in self
@@ -287,38 +765,104 @@ class Container(RDFSource):
 		if type(self.contains) in [str, unicode]:
 			self.contains = [self.contains]
 		self.contains.append(what.uri)
+		if self.paged and not what.uri in self._contains_index:
+			self._contains_order.append(what.uri)
+		self._contains_index.add(what.uri)
 		self._contains_map[what.uri] = what
 
-	def retrieve_children(self, rdr):
-		if type(self.contains) == list:
-			for uri in self.contains:
-				uri = rdr.get_uri(uri)
-				yield self.retrieve_child(uri, rdr)
-		else:
-			yield self.retrieve_child(rdr.get_uri(self.contains), rdr)
-
-	def retrieve_child(self, uri, rdr):
+	def iter_contains(self, rdr):
+		# Generator of contained URIs
+		# Paged containers are streamed page by page, following rel="next"
+		if not self.paged:
+			for uri in self.get_contains_list():
+				yield rdr.get_uri(uri)
+			return
+
+		# Pages already fetched, by anyone, are not fetched again
+		i = 0
+		while True:
+			while i < len(self._contains_order):
+				yield self._contains_order[i]
+				i += 1
+			if self._paged_complete:
+				return
+			self.fetch_page(rdr)
+
+	def fetch_page(self, rdr):
+		# The next page of containment, into _contains_order
+		# just the URIs, contains is deliberately left unmaterialized
+		page = self._next_page or self.links.get('first', [self.uri])[0]
+		req = requests.get(url=page, headers=rdr.ldp_headers_page)
+		req.raise_for_status()
+		js = rdr.clean_jsonld(req.json(), self.uri)
+		kids = js.get('contains', [])
+		if type(kids) != list:
+			kids = [kids]
+		for k in kids:
+			uri = rdr.get_uri(k)
+			if not uri in self._contains_index:
+				self._contains_index.add(uri)
+				self._contains_order.append(uri)
+		self._next_page = parse_link_header(req.headers.get('link', '')).get('next', [None])[0]
+		if not self._next_page:
+			self._paged_complete = True
+
+	def has_child(self, uri, rdr):
+		# Pages on from where paging got to, until it's found
+		while not uri in self._contains_index and self.paged and not self._paged_complete:
+			self.fetch_page(rdr)
+		return uri in self._contains_index
+
+	def retrieve_children(self, rdr, readahead=0):
+		# readahead keeps that many following children being fetched
+		# while the current one is processed
+		if readahead:
+			fetch = lambda uri: self.prefetch_child(uri, rdr)
+			for (uri, req) in Prefetcher(fetch, self.iter_contains(rdr), readahead, close=rdr.drop):
+				yield self.retrieve_child(uri, rdr, req)
+			return
+
+		if rdr.processes and not self.paged:
+			# parsing overlaps with fetching the next few children
+			for (uri, what) in rdr.iter_many(self.iter_contains(rdr), skip=self._contains_map):
+				if what is None:
+					what = self._contains_map[uri]
+				self._contains_map[uri] = what
+				yield what
+			return
+		for uri in self.iter_contains(rdr):
+			yield self.retrieve_child(uri, rdr)
+
+	def prefetch_child(self, uri, rdr):
+		if self._contains_map.has_key(uri) or rdr.object_map.has_key(uri):
+			return None
+		return rdr.fetch(uri)
+
+	def retrieve_child(self, uri, rdr, response=None):
 		# Allow passing in slug
 		if not uri.startswith(self.uri) and not uri.startswith('http'):
 			uri = os.path.join(self.uri, uri)
 
 		if self._contains_map.has_key(uri):
+			rdr.drop(response)
 			return self._contains_map[uri]
-		elif not uri in self.contains:
+		elif not self.has_child(uri, rdr):
 			# we don't have that resource as a child
+			rdr.drop(response)
 			raise ValueError()
 
-		what = rdr.retrieve(uri)
+		what = rdr.retrieve(uri, response=response)
 		self._contains_map[uri] = what
 		return what
 
-	def head_children(self, rdr):
-		if type(self.contains) == list:
-			for uri in self.contains:
-				uri = rdr.get_uri(uri)
-				yield self.head_child(uri, rdr)
+	def head_children(self, rdr, readahead=0):
+		if readahead:
+			head = lambda uri: self.head_child(uri, rdr)
+			for (uri, what) in Prefetcher(head, self.iter_contains(rdr), readahead):
+				yield what
 		else:
-			yield self.head_child(rdr.get_uri(self.contains), rdr)
+			for uri in self.iter_contains(rdr):
+				yield self.head_child(uri, rdr)
 	
 	def head_child(self, uri, rdr):
 		# Allow passing in slug
@@ -327,7 +871,7 @@ class Container(RDFSource):
 
 		if self._contains_map.has_key(uri):
 			return self._contains_map[uri]
-		elif not uri in self.contains:
+		elif not self.has_child(uri, rdr):
 			# we don't have that resource as a child
 			raise ValueError()
 		what = rdr.head(uri)
@@ -377,6 +921,8 @@ class DirectContainer(Container):
 		# _children is now a generator
 		kids = list(self.retrieve_children(reader))
 		setattr(self.membershipResource, prop, kids)
+		if reader.index is not None:
+			reader.index.add_members(self.membershipResource, prop, kids)
 
 
 class IndirectContainer(DirectContainer):
@@ -409,6 +955,8 @@ class IndirectContainer(DirectContainer):
 		for k in kids:
 			vals.append(getattr(k, icprop))
 		setattr(self.membershipResource, myprop, vals)
+		if reader.index is not None:
+			reader.index.add_members(self.membershipResource, myprop, vals)
 	
 
 class JsonLdContext(object):
@@ -433,6 +981,7 @@ class JsonLdContext(object):
 				elif v['@id'] == "@type":
 					self.type_alias = k
 
+		self._terms = None
 		self.namespaces = {}
 		for pfx,val in self.data.items():
 			if type(val) in [str, unicode] and val.startswith('http'):
@@ -453,13 +1002,243 @@ class JsonLdContext(object):
 			pfxs.append("PREFIX %s: <%s>" % (k,v))
 		return pfxs
 
-class LDPReader(object):
+	def expand_iri(self, value):
+		# term or prefix:name to full IRI
+		if self.data.has_key(value):
+			iri = self.get_mapping(value)
+			if iri != value and not iri.startswith('@'):
+				return self.expand_iri(iri)
+			return iri
+		if value.find(':') > -1:
+			pfx, local = value.split(':', 1)
+			if self.namespaces.has_key(pfx):
+				return self.namespaces[pfx] + local
+		return value
+
+	def get_terms(self):
+		# full IRI -> (term, type coercion) for non-prefix terms
+		if self._terms is None:
+			terms = {}
+			for (k, v) in self.data.items():
+				if k.startswith('@') or self.namespaces.has_key(k):
+					continue
+				iri = self.expand_iri(k)
+				if iri.startswith('@'):
+					continue
+				coerce = v.get('@type') if type(v) == dict else None
+				if coerce and coerce != '@id':
+					coerce = self.expand_iri(coerce)
+				# prefer the shortest, then lowest, term as JSON-LD does
+				if not terms.has_key(iri) or (len(k), k) < (len(terms[iri][0]), terms[iri][0]):
+					terms[iri] = (k, coerce)
+			self._terms = terms
+		return self._terms
+
+	def compact_iri(self, iri, vocab=True):
+		# Full IRI to term (if vocab) or prefix:name, as compaction would
+		if vocab and self.get_terms().has_key(iri):
+			return self._terms[iri][0]
+		best = iri
+		for (pfx, ns) in self.namespaces.items():
+			if iri.startswith(ns) and len(iri) > len(ns):
+				cand = "%s:%s" % (pfx, iri[len(ns):])
+				if best == iri or (len(cand), cand) < (len(best), best):
+					best = cand
+		return best
+
+class ClassMap(OrderedDict):
+	# class_map that notes when it changes, so the dispatch table is rebuilt
 
-	def __init__(self, context = None):
-		self.ldp_headers_get = {'Accept': 'application/ld+json'}
+	def __init__(self, *args, **kw):
+		self.version = 0
+		super(ClassMap, self).__init__(*args, **kw)
+
+	def __setitem__(self, key, value, *args, **kw):
+		self.version += 1
+		OrderedDict.__setitem__(self, key, value, *args, **kw)
+
+	def __delitem__(self, key, *args, **kw):
+		self.version += 1
+		OrderedDict.__delitem__(self, key, *args, **kw)
+
+	def clear(self):
+		self.version += 1
+		OrderedDict.clear(self)
+
+class Flight(object):
+	# A request in progress that other threads can wait on
+	def __init__(self):
+		self.owner = threading.current_thread()
+		# set once the instance is in object_map, before build_from_rdf
+		self.registered = threading.Event()
+		self.done = threading.Event()
+		self.instance = None
+		self.error = None
+
+class ResourceIndex(object):
+	# Incrementally maintained lookup tables over retrieved resources
+	# so that queries are dictionary lookups rather than graph walks
+
+	def __init__(self, reader):
+		self.reader = reader
+		self.by_type = {}
+		self.by_value = {}
+		# (uri, property) -> [uri], from build_contents
+		self.members = {}
+		# uri -> set of (uri, property)
+		self.member_of = {}
+		# uri -> (types, (predicate, value) pairs) for re-indexing
+		self.entries = {}
+		# added but not yet read, so retrieving doesn't parse every body
+		self.pending = []
+		self.lock = threading.RLock()
+
+	def get_json(self, what):
+		if isinstance(what, NonRDFSource):
+			# Binaries are described by their metadata
+			return what.describedby.json if what.describedby else {}
+		return getattr(what, 'json', {})
+
+	def get_types(self, what, js):
+		ctx = self.reader.context
+		types = js.get('@type', js.get(ctx.type_alias, []) if ctx else [])
+		if type(types) != list:
+			types = [types]
+		# as IRIs, so any spelling of a type finds it
+		return set([self.reader.normalize_type(t) for t in types + [what._type]])
+
+	def get_values(self, js):
+		ctx = self.reader.context
+		skip = ['@id', '@type', '@context']
+		if ctx:
+			skip.extend([ctx.id_alias, ctx.type_alias])
+		pairs = set()
+		for (k, v) in js.items():
+			if k in skip:
+				continue
+			if type(v) != list:
+				v = [v]
+			for val in v:
+				if type(val) == dict:
+					if val.has_key('@value'):
+						val = val['@value']
+					else:
+						val = self.reader.get_uri(val)
+				if val is not None and type(val) not in [list, dict]:
+					pairs.add((k, val))
+		return pairs
+
+	def remove(self, uri):
+		with self.lock:
+			if not self.entries.has_key(uri):
+				return
+			types, pairs = self.entries.pop(uri)
+			for t in types:
+				self.by_type[t].discard(uri)
+			for p in pairs:
+				self.by_value[p].discard(uri)
+
+	def add(self, what):
+		with self.lock:
+			self.pending.append(what)
+
+	def update(self):
+		# Index everything added since, before answering a query
+		with self.lock:
+			pending = self.pending
+			self.pending = []
+			for what in pending:
+				self.index_resource(what)
+
+	def index_resource(self, what):
+		uri = what.uri
+		self.remove(uri)
+		js = self.get_json(what)
+		types = self.get_types(what, js)
+		pairs = self.get_values(js)
+		with self.lock:
+			for t in types:
+				self.by_type.setdefault(t, set()).add(uri)
+			for p in pairs:
+				self.by_value.setdefault(p, set()).add(uri)
+			self.entries[uri] = (types, pairs)
+
+	def add_members(self, what, prop, kids):
+		key = (what.uri, prop)
+		uris = [k.uri for k in kids]
+		with self.lock:
+			for old in self.members.get(key, []):
+				self.member_of[old].discard(key)
+			self.members[key] = uris
+			for k in uris:
+				self.member_of.setdefault(k, set()).add(key)
+
+	def find(self, typ=None, predicate=None, value=None):
+		self.update()
+		results = None
+		if typ:
+			results = set(self.by_type.get(self.reader.normalize_type(typ), []))
+		if predicate:
+			vals = self.by_value.get((predicate, value), set())
+			results = set(vals) if results is None else results & vals
+		return results if results is not None else set(self.entries.keys())
+
+	def get_values_of(self, uri, predicate):
+		self.update()
+		if not self.entries.has_key(uri):
+			return []
+		return [v for (p, v) in self.entries[uri][1] if p == predicate]
+
+	def get_members(self, uri, prop):
+		return self.members.get((uri, prop), [])
+
+	def get_member_of(self, uri, prop=None):
+		return set([s for (s, p) in self.member_of.get(uri, []) if prop is None or p == prop])
+
+	def descendants(self, uri, props):
+		# Everything reachable from uri through the given properties
+		found = set()
+		todo = [uri]
+		while todo:
+			curr = todo.pop()
+			for p in props:
+				for kid in self.members.get((curr, p), []):
+					if not kid in found:
+						found.add(kid)
+						todo.append(kid)
+		return found
+
+
+class LDPReader(object):
 
-		cmap = OrderedDict()
+	def __init__(self, context = None, processes=0, page_size=1000, stream_containers=False,
+			store=None, rdf_format='jsonld', index=None):
+		if rdf_format == 'ntriples':
+			# cheaper to parse than compacting JSON-LD
+			self.ldp_headers_get = {'Accept': 'application/n-triples'}
+		else:
+			self.ldp_headers_get = {'Accept': 'application/ld+json'}
+		# LDP Paging: fetch containers without containment, then by page
+		self.ldp_headers_minimal = {'Accept': 'application/ld+json',
+			'Prefer': 'return=representation; omit="%s %s"' % (LDP_CONTAINMENT, LDP_MEMBERSHIP)}
+		self.ldp_headers_page = {'Accept': 'application/ld+json',
+			'Prefer': 'return=representation; include="%s"; omit="%s"; page-size-hint=%d' % (
+				LDP_CONTAINMENT, LDP_MEMBERSHIP, page_size)}
+		# >0 to parse and compact JSON-LD in a process pool
+		self.processes = processes
+		self.pool = None
+		# Shared between threads, see retrieve
+		self._lock = threading.RLock()
+		self._flights = {}
+		self._head_flights = {}
+		self._local = threading.local()
+		self._parsed = {}
+		# parse container responses incrementally, requires ijson
+		self.stream_containers = stream_containers and ijson is not None
+
+		cmap = ClassMap()
 		# from worst to best so subclasses can just add
+		# keys are matched as IRIs, so prefixed names or context terms both work
 
 		cmap['ldp:RDFSource'] = RDFSource
 		cmap['ldp:NonRDFSource'] = NonRDFSource
@@ -467,13 +1246,21 @@ class LDPReader(object):
 		cmap['ldp:IndirectContainer'] = IndirectContainer
 		cmap['ldp:DirectContainer'] = DirectContainer
 		cmap['ldp:BasicContainer'] = BasicContainer
-		cmap['IndirectContainer'] = IndirectContainer
-		cmap['DirectContainer'] = DirectContainer
-		cmap['BasicContainer'] = BasicContainer
 		self.class_map = cmap
+		self._dispatch = None
+		self._dispatch_key = None
 
-		self.object_map = {}
+		# store is a persistent mapping to use instead, eg SqliteObjectStore
+		if store is not None:
+			store.bind(self)
+			self.object_map = store
+		else:
+			self.object_map = {}
 		self.property_map = {}
+		# The index is held in memory, so by default it is off with a store
+		if index is None:
+			index = store is None
+		self.index = ResourceIndex(self) if index else None
 
 		if context:
 			if isinstance(context, JsonLdContext):
@@ -496,84 +1283,331 @@ class LDPReader(object):
 				return None
 
 	def clean_jsonld(self, js, uri):
-		if type(js) == list:
-			# find actual object
-			# NB for fcr:metadata it's not retrieved URI
-			for o in js:
-				if o['@id'] == uri or (self.context.id_alias and o.get(self.context.id_alias, '') == uri):
-					js = o
-					break
-
-		js = jsonld.compact(js, self.context.data)
-		del js['@context']
+		return compact_jsonld(js, uri, self.context.data, self.context.id_alias)
+
+	def get_pool(self):
+		# Worker processes for JSON-LD parsing and compaction
+		with self._lock:
+			if self.pool is None and self.processes:
+				self.pool = multiprocessing.Pool(self.processes, _init_jsonld_worker,
+					(self.context.data, self.context.id_alias))
+		return self.pool
+
+	def close(self):
+		if self.pool is not None:
+			self.pool.close()
+			self.pool.join()
+			self.pool = None
+
+	def has_json(self, uri):
+		return self._parsed.has_key(uri)
+
+	def get_body(self, req):
+		# Streamed responses have already been consumed
+		if getattr(req, 'streamed', False):
+			return ""
+		return req.content
+
+	def is_container_response(self, req):
+		types = parse_link_header(req.headers.get('link', '')).get('type', [])
+		return any([t in LDP_CONTAINER_TYPES for t in types])
+
+	def stream_container(self, req, uri):
+		req.raw.decode_content = True
+		node, contains = stream_jsonld(req.raw, uri, self.context.id_alias)
+		# marked on the response itself, so it can't outlive it
+		req.streamed = True
+		if node is None:
+			raise ValueError("Could not find %s in streamed response" % uri)
+		js = self.clean_jsonld(node, uri)
+		if contains:
+			js['contains'] = contains
 		return js
 
-	def retrieve(self, uri, instance=None, target=None):
+	def get_json(self, req, uri):
+		# Reuse the compaction already done while retrieving, if any
+		if self._parsed.has_key(uri):
+			return self._parsed.pop(uri)
+		return self.parse_response(req, uri)
 
-		if self.object_map.has_key(uri):
-			return self.object_map[uri]
+	def parse_response(self, req, uri):
+		return self.parse_body(req.content, req.headers.get('content-type', ''), uri)
+
+	def parse_body(self, body, ct, uri):
+		if ct.startswith('application/n-triples'):
+			return parse_ntriples(body.splitlines(), uri, self.context)
+		return self.clean_jsonld(json.loads(body), uri)
 
+	def is_jsonld(self, req):
+		return req.headers.get('content-type', '').startswith('application/ld+json')
+
+	def is_rdf_type(self, ct):
+		return ct.startswith('application/ld+json') or ct.startswith('application/n-triples')
+
+	def is_rdf(self, req):
+		return self.is_rdf_type(req.headers.get('content-type', ''))
+
+	def fetch(self, uri, headers=None):
 		print "Fetching: " + uri
-		req = requests.get(url=uri, headers=self.ldp_headers_get)
+		req = requests.get(url=uri, headers=headers or self.ldp_headers_get,
+			stream=self.stream_containers)
 		req.raise_for_status()
-
-		ct = req.headers.get('content-type', '')
+		return req
+
+	def retrieve(self, uri, instance=None, target=None, minimal=False, response=None):
+		# minimal=True omits containment; children are then paged in by
+		# Container.iter_contains as they are iterated
+		# response is an already fetched GET of uri, eg from prefetching
+
+		# Concurrent calls for the same uri share one request
+		# object_map is only read outside the lock, as a store may rebuild
+		# the instance, which retrieves what it refers to
+		mine = False
+		with self._lock:
+			flight = self._flights.get(uri)
+			if flight is None and not self.object_map.has_key(uri):
+				flight = Flight()
+				self._flights[uri] = flight
+				mine = True
+		if not mine:
+			self.drop(response)
+			if flight is None or flight.owner is threading.current_thread():
+				# already built, or we're building it and got back here by recursion
+				return self.object_map[uri]
+			return self.wait_flight(uri, flight)
+
+		self._local.depth = getattr(self._local, 'depth', 0) + 1
+		try:
+			if response is not None:
+				req = response
+			elif minimal:
+				req = self.fetch(uri, self.ldp_headers_minimal)
+			else:
+				req = self.fetch(uri)
+			flight.instance = self.build_instance(uri, req, instance=instance, target=target, paged=minimal)
+		except Exception, e:
+			flight.error = e
+			# don't leave a half built instance behind
+			with self._lock:
+				if self.object_map.has_key(uri):
+					del self.object_map[uri]
+			raise
+		finally:
+			self._local.depth -= 1
+			with self._lock:
+				del self._flights[uri]
+			flight.registered.set()
+			flight.done.set()
+		return flight.instance
+
+	def drop(self, response):
+		# A fetched response that won't be used, release its connection
+		if response is not None:
+			response.close()
+
+	def wait_flight(self, uri, flight):
+		# Threads that are building something themselves only wait for
+		# the instance to exist, as with recursion in a single thread, so
+		# two builds that need each other can't deadlock
+		if getattr(self._local, 'depth', 0) > 0:
+			flight.registered.wait()
+		else:
+			flight.done.wait()
+		if flight.error is not None and not self.object_map.has_key(uri):
+			raise flight.error
+		return flight.instance if flight.done.is_set() else self.object_map[uri]
+
+	def register(self, uri, instance, complete=False):
+		# A store only keeps an incomplete instance live, not on disk
+		live = getattr(self.object_map, 'cache_put', None)
+		with self._lock:
+			if complete or live is None:
+				self.object_map[uri] = instance
+			else:
+				live(uri, instance)
+			flight = self._flights.get(uri)
+		if flight is not None:
+			flight.registered.set()
+
+	def retrieve_many(self, uris):
+		return [what for (uri, what) in self.iter_many(uris)]
+
+	def iter_many(self, uris, window=0, skip=None):
+		# Generator of (uri, instance), fetching in order while the pool
+		# parses bodies already received. Instances are still built here,
+		# in order, and at most window responses are held at once
+		# uris in skip are not fetched, and come back as (uri, None)
+		window = window or max(self.processes, 1) * 2
+		pool = self.get_pool()
+		pending = deque()
+		try:
+			for uri in uris:
+				if skip is not None and uri in skip:
+					pending.append((uri, None, None, True))
+				elif self.object_map.has_key(uri):
+					pending.append((uri, None, None, False))
+				else:
+					req = self.fetch(uri)
+					res = None
+					if pool and self.is_jsonld(req) and not \
+							(self.stream_containers and self.is_container_response(req)):
+						res = pool.apply_async(_parse_jsonld, (req.content, uri))
+					pending.append((uri, req, res, False))
+				while len(pending) > window:
+					yield self.build_pending(pending.popleft())
+			while pending:
+				yield self.build_pending(pending.popleft())
+		finally:
+			for (uri, req, res, skipped) in pending:
+				if req is not None:
+					req.close()
+
+	def build_pending(self, item):
+		uri, req, res, skipped = item
+		if skipped:
+			return (uri, None)
+		if res is not None:
+			# picked up by build_instance via get_json
+			js = res.get()
+			with self._lock:
+				self._parsed[uri] = js
+		try:
+			# if already built, perhaps by an earlier build_from_rdf,
+			# the response is simply dropped
+			return (uri, self.retrieve(uri, response=req))
+		finally:
+			with self._lock:
+				self._parsed.pop(uri, None)
+
+	def get_dispatch(self):
+		# class_map compiled to IRI -> (rank, class), rebuilt if it or the context changes
+		key = (id(self.class_map), getattr(self.class_map, 'version', None), id(self.context))
+		with self._lock:
+			if self._dispatch is None or self._dispatch_key != key or \
+					not isinstance(self.class_map, ClassMap):
+				table = {}
+				for (rank, (k, cls)) in enumerate(self.class_map.items()):
+					table[self.normalize_type(k)] = (rank, cls)
+				# LDP types are also in the Link header, so no body is needed
+				links = all([k.startswith(LDP_NS) for k in table.keys()])
+				self._dispatch = (table, set(table.keys()), {}, links)
+				self._dispatch_key = key
+			return self._dispatch
+
+	def link_dispatch(self):
+		return self.get_dispatch()[3]
+
+	def normalize_type(self, typ):
+		if self.context is None:
+			return typ
+		return self.context.expand_iri(typ)
+
+	def find_class(self, types):
+		# Best ranked class for any of types, or None
+		table, keys, iris, links = self.get_dispatch()
+		if type(types) in [str, unicode]:
+			types = [types]
+		norm = set()
+		for t in types:
+			iri = iris.get(t)
+			if iri is None:
+				iri = self.normalize_type(t)
+				iris[t] = iri
+			norm.add(iri)
+		hits = keys & norm
+		if not hits:
+			return None
+		return max([table[h] for h in hits])[1]
+
+	def build_instance(self, uri, req, instance=None, target=None, paged=False):
 		# Find most appropriate @type
 		clean_uri = target if target else uri
-		if ct.startswith('application/ld+json'):
+		if self.is_rdf(req):
+			js = None
+			if self.stream_containers and self.is_jsonld(req) and not self.has_json(clean_uri) \
+					and self.is_container_response(req):
+				js = self.stream_container(req, clean_uri)
 			# Grab the json and look for classes
 			if instance == None:
-				js = self.clean_jsonld(req.json(), clean_uri)
-				# N.B. stepping through from end to beginning
 				tomake = None
-				types = js.get("@type", js.get(self.context.type_alias, []))
-				for k,v in reversed(self.class_map.items()):
-					if k in types:
-						tomake = v
-						break
+				if js is None and self.link_dispatch():
+					# so the body can be left for RDFSource.json to parse
+					tomake = self.find_class(parse_link_header(req.headers.get('link', '')).get('type', []))
+				if tomake is None:
+					if js is None:
+						js = self.get_json(req, clean_uri)
+					types = js.get("@type", js.get(self.context.type_alias, []))
+					tomake = self.find_class(types)
 				if tomake == None:
 					raise ValueError("Could not find class to build in class_map")
 
 				# make a tomake()
 				instance = tomake(uri)
-				instance.context = self.context
-				self.object_map[uri]= instance
-				instance.http_setup(req, self, target=clean_uri)
-				instance.build_from_rdf(self)
 
-			else:
-				instance.context = self.context
-				self.object_map[uri] = instance
-				instance.http_setup(req, self, target=clean_uri)
-				instance.build_from_rdf(self)
+			if paged and isinstance(instance, Container):
+				# mark before build_from_rdf runs
+				instance.paged = True
+
+			instance.context = self.context
+			self.register(uri, instance)
+			if js is not None:
+				# handed on to RDFSource.http_setup via get_json
+				self._parsed[clean_uri] = js
+			instance.http_setup(req, self, target=clean_uri)
+			self._parsed.pop(clean_uri, None)
+			instance.build_from_rdf(self)
 
 		else:
 			# NonRdfSource, make a ldp:NonRdfSource
 			instance = NonRDFSource(uri)						
-			self.object_map[uri] = instance
+			self.register(uri, instance)
 			instance.http_setup(req, self)
 
+		# again now it's complete, which is when persistent object maps save it
+		self.register(uri, instance, complete=True)
+		if self.index is not None:
+			self.index.add(instance)
 		return instance
 
 	def head(self, uri, instance=None):
 		# Useful if you want to delete stuff with If-Match
 
 		if self.object_map.has_key(uri):
+			# outside the lock, see retrieve
 			return self.object_map[uri]
+		with self._lock:
+			flight = self._head_flights.get(uri)
+			if flight is None:
+				flight = Flight()
+				self._head_flights[uri] = flight
+		if flight.owner is not threading.current_thread():
+			# someone else is already asking
+			flight.done.wait()
+			if flight.error is not None:
+				raise flight.error
+			return flight.instance
 
-		req = requests.head(url=uri, headers=self.ldp_headers_get)
-		req.raise_for_status()
+		try:
+			req = requests.head(url=uri, headers=self.ldp_headers_get)
+			req.raise_for_status()
 
-		ct = req.headers.get('content-type', '')
-		if ct.startswith('application/ld+json'):
-			# Just make an RDFSource as we don't know what else to do
-			#    without the content to inspect for @type
-			instance = RDFSource(uri)
-			instance.context = self.context  # probably unnecessary
-			instance.http_setup(req, self)
-		else:
-			# NonRdfSource, make a ldp:NonRdfSource
-			instance = NonRDFSource(uri)						
-			instance.http_setup(req, self)
+			if self.is_rdf(req):
+				# Just make an RDFSource as we don't know what else to do
+				#    without the content to inspect for @type
+				instance = RDFSource(uri)
+				instance.context = self.context  # probably unnecessary
+				instance.http_setup(req, self)
+			else:
+				# NonRdfSource, make a ldp:NonRdfSource
+				instance = NonRDFSource(uri)						
+				instance.http_setup(req, self)
+			flight.instance = instance
+		except Exception, e:
+			flight.error = e
+			raise
+		finally:
+			with self._lock:
+				del self._head_flights[uri]
+			flight.done.set()
 
 		return instance
@@ -5,8 +5,8 @@ from pycdm import Object as PcdmObject
 from pycdm import PcdmReader as PcdmReaderBase
 
 class PcdmReader(PcdmReaderBase):
-	def __init__(self, context = None):
-		super(PcdmReader, self).__init__(context)
+	def __init__(self, context = None, **kw):
+		super(PcdmReader, self).__init__(context, **kw)
 		self.class_map['pcdm:Object'] = Object
 		self.class_map['pcdm:Collection'] = Collection
 		self.property_map['pcdm:hasMaster'] = 'master'
@@ -0,0 +1,256 @@
+import os
+
+import requests
+
+from ldp import get_remote_digests
+from pycdm import PcdmResource, Object, Proxy
+from session import Session
+
+# Push a locally built Collection/Object tree to the repository by
+# comparing it with what is already there, and only writing what differs.
+# The writes go through a Session, so they run concurrently in
+# dependency order.
+# NB members that are removed lose their proxy, the member resource
+# itself is left alone, as are remote files with no local counterpart,
+# and properties removed locally are not deleted
+
+# Properties that are structural or managed by the repository
+STRUCTURAL = ['@id', '@type', '@context', 'contains', 'first', 'last',
+	'memberContainer', 'relatedContainer', 'fileContainer', 'membershipResource',
+	'hasMemberRelation', 'isMemberOfRelation', 'insertedContentRelation',
+	'proxyFor', 'proxyIn', 'next', 'prev']
+
+def as_list(value):
+	if type(value) == list:
+		return value
+	return [value]
+
+def normalize_value(value, ctx, coerce=None):
+	# JSON-LD value, local or compacted, to a comparable
+	# ('id', iri) or ('literal', value, datatype iri, language)
+	if type(value) == dict:
+		if value.has_key('@value'):
+			dt = value.get('@type')
+			return ('literal', value['@value'], ctx.expand_iri(dt) if dt else None,
+				value.get('@language'))
+		return ('id', ctx.expand_iri(value.get('@id', value.get(ctx.id_alias, ''))))
+	if coerce == '@id':
+		return ('id', ctx.expand_iri(value))
+	elif coerce:
+		return ('literal', value, coerce, None)
+	if type(value) in [str, unicode] and value.startswith('http') and value.find(' ') == -1:
+		# as RDFSource.get_triple would write it
+		return ('id', value)
+	return ('literal', value, None, None)
+
+def sparql_value(value):
+	# normalized value to SPARQL
+	if value[0] == 'id':
+		return '<%s>' % value[1]
+	lit = value[1]
+	if type(lit) == bool:
+		return 'true' if lit else 'false'
+	elif type(lit) in [int, long, float]:
+		return repr(lit)
+	lit = unicode(lit).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+	if value[2]:
+		return '"%s"^^<%s>' % (lit, value[2])
+	elif value[3]:
+		return '"%s"@%s' % (lit, value[3])
+	return '"%s"' % lit
+
+
+class MirrorPush(object):
+
+	def __init__(self, reader, threads=8):
+		self.reader = reader
+		self.session = Session(threads)
+		self.stats = {'created': 0, 'updated': 0, 'reordered': 0, 'deleted': 0, 'unchanged': 0}
+		self.seen = set()
+
+	def push(self, local, container):
+		# local is pushed into container, an existing repository Container
+		self.push_resource(local, container)
+		self.session.flush()
+		self.seen = set()
+		return dict(self.stats)
+
+	def get_remote(self, uri):
+		try:
+			return self.reader.retrieve(uri)
+		except requests.HTTPError, e:
+			if e.response is not None and e.response.status_code in [404, 410]:
+				return None
+			raise
+
+	def push_resource(self, local, container, create=None):
+		# create records the creation of local, if it is new
+		if local in self.seen:
+			return
+		self.seen.add(local)
+
+		uri = local.uri
+		if not uri and container is not None and container.uri:
+			uri = os.path.join(container.uri, local.slug)
+		remote = self.get_remote(uri) if uri else None
+
+		if remote is None:
+			if create:
+				create()
+			else:
+				self.session.create_child(container, local)
+			self.stats['created'] += 1
+			target = local
+		else:
+			# conditional writes against what we compared with
+			local.uri = remote.uri
+			local.etag = remote.etag
+			self.push_properties(local, remote)
+			target = remote
+
+		if isinstance(local, PcdmResource):
+			for m in local.members:
+				self.push_resource(m, m.container or container)
+			self.push_members(local, target, remote)
+		if isinstance(local, Object):
+			self.push_files(local, target, remote)
+		for fs in getattr(local, 'filesets', []):
+			fscontainer = remote.filesetsContainer if remote is not None else None
+			self.push_resource(fs, fscontainer,
+				create=lambda fs=fs: self.session.add_fileset(target, fs))
+
+	def get_values(self, js):
+		# {predicate iri: set of normalized values}, without structure
+		ctx = self.reader.context
+		skip = set([ctx.expand_iri(k) for k in STRUCTURAL + [ctx.id_alias, ctx.type_alias]])
+		terms = ctx.get_terms()
+		values = {}
+		for (k, v) in js.items():
+			pred = ctx.expand_iri(k)
+			if pred in skip:
+				continue
+			coerce = terms[pred][1] if terms.has_key(pred) and terms[pred][0] == k else None
+			vals = values.setdefault(pred, set())
+			for x in as_list(v):
+				vals.add(normalize_value(x, ctx, coerce))
+		return values
+
+	def push_properties(self, local, remote):
+		# Compared as IRIs, so rdfs:label locally matches label remotely
+		lvals = self.get_values(local.json)
+		rvals = self.get_values(remote.json)
+		inserts = []
+		deletes = []
+		for (pred, vals) in lvals.items():
+			have = rvals.get(pred, set())
+			field = '<%s>' % pred
+			inserts.extend([(field, sparql_value(x)) for x in vals - have])
+			deletes.extend([(field, sparql_value(x)) for x in have - vals])
+		if inserts or deletes:
+			self.session.patch_fields(remote, inserts, deletes)
+			self.stats['updated'] += 1
+		else:
+			self.stats['unchanged'] += 1
+
+	def get_remote_proxies(self, remote):
+		proxies = list(remote.membersContainer.retrieve_children(self.reader))
+		if not remote.ordered:
+			return proxies
+		# follow first / next
+		byuri = dict([(p.uri, p) for p in proxies])
+		ordered = []
+		curr = remote.json.get('first')
+		while curr:
+			p = byuri.pop(self.reader.get_uri(curr), None)
+			if p is None:
+				break
+			ordered.append(p)
+			curr = p.json.get('next')
+		return ordered + byuri.values()
+
+	def push_members(self, local, target, remote):
+		existing = {}
+		if remote is not None:
+			for p in self.get_remote_proxies(remote):
+				existing.setdefault(p.proxy_for.uri, []).append(p)
+
+		proxies = []
+		for m in local.members:
+			if m.uri and existing.get(m.uri):
+				proxies.append(existing[m.uri].pop(0))
+			else:
+				p = Proxy(slug=m.slug + "_proxy")
+				p.proxy_for = m
+				p.proxy_in = target
+				if local.ordered and proxies:
+					p.prev = proxies[-1]
+				self.session.add_proxy(target, p)
+				proxies.append(p)
+
+		for plist in existing.values():
+			for p in plist:
+				self.session.delete(p)
+				self.stats['deleted'] += 1
+
+		if local.ordered:
+			self.push_order(target, proxies)
+
+	def push_order(self, target, proxies):
+		# Patch next/prev and first/last wherever they differ
+		changed = False
+		for (i, p) in enumerate(proxies):
+			want = {'prev': proxies[i-1] if i > 0 else None,
+				'next': proxies[i+1] if i+1 < len(proxies) else None}
+			if not p.uri:
+				# new: prev was set on creation, next has to follow
+				if want['next'] is not None:
+					self.session.patch_fields(p, [('next', want['next'])])
+				continue
+			changed = self.patch_links(p, want) or changed
+
+		want = {'first': proxies[0] if proxies else None,
+			'last': proxies[-1] if proxies else None}
+		changed = self.patch_links(target, want) or changed
+		if changed:
+			self.stats['reordered'] += 1
+
+	def patch_links(self, what, want):
+		inserts = []
+		deletes = []
+		for (k, w) in want.items():
+			have = self.reader.get_uri(what.json.get(k)) if what.uri and what.json.get(k) else None
+			if w is not None and w.uri and w.uri == have:
+				continue
+			if w is None and have is None:
+				continue
+			if have:
+				deletes.append((k, have))
+			if w is not None:
+				inserts.append((k, w))
+		if inserts or deletes:
+			self.session.patch_fields(what, inserts, deletes)
+			return True
+		return False
+
+	def push_files(self, local, target, remote):
+		remote_files = {}
+		if remote is not None and remote.filesContainer is not None:
+			for uri in remote.filesContainer.iter_contains(self.reader):
+				remote_files[uri.rstrip('/').split('/')[-1]] = uri
+
+		for f in local.files:
+			uri = remote_files.pop(f.slug, None)
+			if uri is None:
+				self.session.add_file(target, f)
+				self.stats['created'] += 1
+				continue
+			if not 'sha1' in f.digest_algorithms:
+				f.digest_algorithms = list(f.digest_algorithms) + ['sha1']
+			f.uri = uri
+			if f.compute_digests()['sha1'] == get_remote_digests(uri).get('sha1'):
+				self.stats['unchanged'] += 1
+			else:
+				self.session.update(f)
+				self.stats['updated'] += 1
+		# files only left in remote_files are kept, as local.files is
+		# not necessarily everything the Object has
@@ -1,10 +1,43 @@
 
 import os
-from ldp import Container, DirectContainer, IndirectContainer, RDFSource, NonRDFSource, LDPReader
+from ldp import Container, DirectContainer, IndirectContainer, RDFSource, NonRDFSource, LDPReader, ResourceIndex
+
+class PcdmIndex(ResourceIndex):
+	# properties that make up the PCDM tree below a resource
+	tree_props = ['members', 'relatedObjects', 'files', 'filesets']
+	file_types = ['pcdm:File']
+	collection_types = ['pcdm:Collection']
+
+	def find_any(self, types):
+		self.update()
+		found = set()
+		for t in types:
+			found.update(self.by_type.get(self.reader.normalize_type(t), []))
+		return found
+
+	def get_files_under(self, uri):
+		# All pcdm:Files anywhere below uri
+		found = self.descendants(uri, self.tree_props)
+		files = found & self.find_any(self.file_types)
+		for f in found:
+			if self.get_member_of(f, 'files'):
+				files.add(f)
+		return files
+
+	def get_containers_of(self, uri):
+		# Collections/Objects that have uri as a member, directly or by Proxy
+		self.update()
+		containers = self.get_member_of(uri, 'members')
+		for p in self.by_value.get(('proxyFor', uri), []):
+			containers.update(self.get_values_of(p, 'proxyIn'))
+		return containers
+
+	def get_collections_of(self, uri):
+		return self.get_containers_of(uri) & self.find_any(self.collection_types)
 
 class PcdmReader(LDPReader):
-	def __init__(self, context = None):
-		super(PcdmReader, self).__init__(context)
+	def __init__(self, context = None, **kw):
+		super(PcdmReader, self).__init__(context, **kw)
 
 		cmap = self.class_map
 
@@ -12,10 +45,6 @@ class PcdmReader(LDPReader):
 		cmap['pcdm:Object'] = Object
 		cmap['pcdm:Collection'] = Collection		
 		cmap['ore:Proxy'] = Proxy
-		cmap['File'] = NonRDFSource
-		cmap['Collection'] = Collection
-		cmap['Proxy'] = Proxy
-		cmap['Object'] = Object
 
 		# in/direct container predicate to object property
 		self.property_map = {
@@ -25,6 +54,8 @@ class PcdmReader(LDPReader):
 			"pcdm:hasRelatedFile": "relatedFiles",
 			"ore:proxyFor": "proxy_for"
 		}
+		if self.index is not None:
+			self.index = PcdmIndex(self)
 
 # PCDM resources contain containers and have members
 class PcdmResource(Container):
@@ -97,8 +128,13 @@ class PcdmResource(Container):
 		js = super(PcdmResource, self).to_jsonld()
 
 		if self.ordered and self.members:
-			js['first'] = self.get_proxy(self.members[0]).uri
-			js['last'] = self.get_proxy(self.members[-1]).uri
+			# proxies may not have been created yet
+			first = self._proxyHash.get(self.members[0])
+			last = self._proxyHash.get(self.members[-1])
+			if first and first.uri:
+				js['first'] = first.uri
+			if last and last.uri:
+				js['last'] = last.uri
 		return js
 
 	def create(self):
@@ -111,6 +147,12 @@ class PcdmResource(Container):
 
 	def add_member(self, what): 
 		# Create & return the proxy for the member object/collection
+		p = self.make_proxy(what)
+		self.membersContainer.create_child(p)
+		return p
+
+	def make_proxy(self, what):
+		# The local half of add_member, the proxy is not created
 		p = Proxy(slug=what.slug+"_proxy")
 		p.proxy_for = what
 		p.proxy_in = self		
@@ -122,11 +164,9 @@ class PcdmResource(Container):
 			# manipulate the object list
 			# We're already in members, note
 			if len(self.members) > 1:
-				prev = self._proxyHash[self.members[-1]]
+				prev = self._proxyHash[self.members[-2]]
 				prev.next = p
 				p.prev = prev
-
-		self.membersContainer.create_child(p)
 		return p
 
 	def remove_member(self, what):
@@ -213,9 +253,9 @@ class Proxy(RDFSource):
 			js['proxyFor'] = self.proxy_for.uri
 		if self.proxy_in:
 			js['proxyIn'] = self.proxy_in.uri
-		if self.next:
+		if self.next and self.next.uri:
 			js['next'] = self.next.uri
-		if self.prev:
+		if self.prev and self.prev.uri:
 			js['prev'] = self.prev.uri
 		return js
 
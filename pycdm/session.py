@@ -0,0 +1,218 @@
+from multiprocessing.pool import ThreadPool
+
+try:
+	from collections import OrderedDict
+except:
+	from ordereddict import OrderedDict
+
+from ldp import DirectContainer, LDPResource
+
+# Unit of work: record creates, membership and patches locally, then
+# write them all in flush() in dependency order, running everything
+# whose dependencies are satisfied concurrently
+
+class Operation(object):
+
+	def __init__(self, func, creates=None, requires=None):
+		self.func = func
+		# the resource this operation gives a URI to, if any
+		self.creates = creates
+		# resources that must have URIs first
+		self.requires = [r for r in (requires or []) if r is not None]
+		self.done = False
+
+	def run(self):
+		self.func()
+		self.done = True
+
+
+class Session(object):
+
+	def __init__(self, threads=8):
+		self.threads = threads
+		self.reset()
+
+	def reset(self):
+		self.ops = []
+		self.creating = {}
+		self.updates = OrderedDict()
+		self.patches = OrderedDict()
+		self.deletes = OrderedDict()
+		# ordered resources given members, for first/last
+		self.ordering = OrderedDict()
+
+	def add(self, op):
+		self.ops.append(op)
+		if op.creates is not None:
+			self.creating[op.creates] = op
+		return op
+
+	def get_references(self, what):
+		# Other resources whose URIs end up in what's representation
+		refs = []
+		if isinstance(what, DirectContainer) and what.membershipResource:
+			refs.append(what.membershipResource)
+		for prop in ['proxy_for', 'proxy_in', 'prev']:
+			refs.append(getattr(what, prop, None))
+		return refs
+
+	def create_child(self, container, what):
+		if self.creating.has_key(what):
+			# already going to be created
+			return what
+		self.add(Operation(lambda: container.create_child(what), creates=what,
+			requires=[container] + self.get_references(what)))
+		return what
+
+	def add_member(self, resource, what):
+		# The proxy and ordering are set up now, the proxy is created at flush
+		p = resource.make_proxy(what)
+		self.add_proxy(resource, p)
+		if resource.ordered:
+			# next, first and last point at proxies that only have URIs
+			# once created, so are patched in afterwards
+			if p.prev is not None:
+				self.patch_fields(p.prev, [('next', p)])
+			self.ordering[resource] = True
+		return p
+
+	def add_proxy(self, resource, p):
+		# membersContainer is looked up when run, as a resource that is
+		# itself being created only gets one then
+		if not self.creating.has_key(p):
+			self.add(Operation(lambda: resource.membersContainer.create_child(p), creates=p,
+				requires=[resource] + self.get_references(p)))
+		return p
+
+	def add_file(self, obj, what):
+		if not self.creating.has_key(what):
+			self.add(Operation(lambda: obj.add_file(what), creates=what, requires=[obj]))
+		return what
+
+	def add_fileset(self, obj, fileset):
+		if not self.creating.has_key(fileset):
+			self.add(Operation(lambda: obj.add_fileset(fileset), creates=fileset,
+				requires=[obj] + self.get_references(fileset)))
+		return fileset
+
+	def update(self, what):
+		# Creates already send the current representation, and a PUT
+		# would replace what create() PATCHed in afterwards
+		if not self.creating.has_key(what):
+			self.updates[what] = True
+
+	def patch_single(self, what, field, value):
+		self.patch_fields(what, [(field, value)])
+
+	def patch_fields(self, what, pairs, deletes=None):
+		# Patches to the same resource go as one PATCH
+		# Values may be resources, whose URIs are used once created
+		inserts, dels = self.patches.setdefault(what, ([], []))
+		inserts.extend(pairs)
+		dels.extend(deletes or [])
+
+	def is_needed(self, what):
+		# True if another pending operation needs what to have a URI
+		for op in self.ops:
+			if op.creates is not what and what in op.requires:
+				return True
+		for (other, (inserts, deletes)) in self.patches.items():
+			if other is not what and what in [v for (f, v) in inserts + deletes]:
+				return True
+		return False
+
+	def delete(self, what, tombstone=False):
+		if self.creating.has_key(what):
+			if self.is_needed(what):
+				raise ValueError("Can't delete a pending create that other pending operations need")
+			# never written, so just forget about it
+			op = self.creating.pop(what)
+			self.ops.remove(op)
+			self.ordering.pop(what, None)
+		else:
+			self.deletes[what] = tombstone
+		self.updates.pop(what, None)
+		self.patches.pop(what, None)
+
+	def get_deletes(self):
+		# Deleting a container deletes what is in it, so only the topmost
+		# are sent, rather than racing parents against their children
+		uris = set([w.uri for w in self.deletes.keys()])
+		tops = []
+		for (what, tombstone) in self.deletes.items():
+			parent = what.uri.rstrip('/')
+			inside = False
+			while parent.find('/') > -1 and not inside:
+				parent = parent.rsplit('/', 1)[0]
+				inside = parent in uris or parent + '/' in uris
+			if not inside:
+				tops.append((what, tombstone))
+		return tops
+
+	def order_patches(self):
+		# first/last of ordered resources, once the proxies exist
+		for resource in self.ordering.keys():
+			if not resource.members:
+				continue
+			ends = [('first', resource._proxyHash.get(resource.members[0])),
+				('last', resource._proxyHash.get(resource.members[-1]))]
+			inserts = []
+			deletes = []
+			for (k, p) in ends:
+				if p is None or not p.uri:
+					continue
+				have = resource.json.get(k)
+				if type(have) == dict:
+					have = have.get('@id', have.get(resource.context.id_alias if resource.context else '@id'))
+				if have == p.uri:
+					continue
+				if have:
+					deletes.append((k, have))
+				inserts.append((k, p))
+			if inserts:
+				self.patch_fields(resource, inserts, deletes)
+		self.ordering.clear()
+
+	def is_ready(self, op):
+		for r in op.requires:
+			if self.creating.has_key(r) and not self.creating[r].done:
+				return False
+		return True
+
+	def run_all(self, pool, funcs):
+		if funcs:
+			pool.map(lambda f: f(), funcs)
+
+	def flush(self):
+		pool = ThreadPool(self.threads)
+		try:
+			while self.ops:
+				ready = [op for op in self.ops if self.is_ready(op)]
+				if not ready:
+					raise ValueError("Circular dependency between pending operations")
+				try:
+					self.run_all(pool, [op.run for op in ready])
+				finally:
+					self.ops = [op for op in self.ops if not op.done]
+
+			self.run_all(pool, [what.update for what in self.updates.keys()])
+			self.updates.clear()
+
+			self.order_patches()
+
+			def resolve(pairs):
+				return [(f, v.uri if isinstance(v, LDPResource) else v) for (f, v) in pairs]
+			def patch(what, changes):
+				inserts, deletes = changes
+				# children may have changed the etag since creation
+				what.update_etag()
+				what.patch_fields(resolve(inserts), resolve(deletes))
+			self.run_all(pool, [(lambda w=w, p=p: patch(w, p)) for (w, p) in self.patches.items()])
+			self.patches.clear()
+
+			self.run_all(pool, [(lambda w=w, t=t: w.delete(tombstone=t)) for (w, t) in self.get_deletes()])
+			self.deletes.clear()
+		finally:
+			pool.close()
+			pool.join()
+		self.creating = {}
@@ -0,0 +1,168 @@
+import json
+import sqlite3
+import threading
+import weakref
+
+try:
+	from collections import OrderedDict
+except:
+	from ordereddict import OrderedDict
+
+from ldp import RDFSource, NonRDFSource, parse_link_header
+
+# Persistent replacement for LDPReader.object_map
+# Each retrieved resource is kept as its compacted JSON, headers and
+# class_map key, and is rebuilt through class_map when next asked for.
+# Only the most recently used instances are kept in the cache, but an
+# evicted instance that something else still refers to is handed back
+# rather than rebuilt, so there is only ever one instance per URI.
+# The reader's ResourceIndex is in memory, so is off by default with a store.
+# NB binary content of NonRDFSources is not stored
+
+class SqliteObjectStore(object):
+
+	def __init__(self, filename, cache_size=10000, commit_every=1000):
+		self.filename = filename
+		self.cache_size = cache_size
+		self.commit_every = commit_every
+		self._writes = 0
+		self.cache = OrderedDict()
+		# every instance still referenced anywhere, cached or not
+		self.live = weakref.WeakValueDictionary()
+		self.reader = None
+		self.lock = threading.RLock()
+		self.conn = sqlite3.connect(filename, check_same_thread=False)
+		self.conn.execute("CREATE TABLE IF NOT EXISTS objects (uri TEXT PRIMARY KEY, "
+			"type TEXT, headers TEXT, json TEXT)")
+		self.conn.commit()
+
+	def bind(self, reader):
+		self.reader = reader
+
+	def sync(self):
+		with self.lock:
+			self.conn.commit()
+			self._writes = 0
+
+	def close(self):
+		self.sync()
+		self.conn.close()
+
+	def get_type_key(self, what):
+		for (k, v) in self.reader.class_map.items():
+			if v is what.__class__:
+				return k
+		return what._type
+
+	def cache_put(self, uri, what):
+		# also how the reader registers instances still being built,
+		# which are only saved once complete
+		with self.lock:
+			self.cache.pop(uri, None)
+			self.cache[uri] = what
+			self.live[uri] = what
+			while len(self.cache) > self.cache_size:
+				self.cache.popitem(last=False)
+
+	def save(self, what):
+		hdrs = {'etag': what.etag, 'last-modified': what.lastModified,
+			'link': what.link_header, 'content-type': what.contentType}
+		js = what.json if isinstance(what, RDFSource) else {}
+		with self.lock:
+			self.conn.execute("INSERT OR REPLACE INTO objects (uri, type, headers, json) "
+				"VALUES (?, ?, ?, ?)", (what.uri, self.get_type_key(what), json.dumps(hdrs), json.dumps(js)))
+			self._writes += 1
+			if self._writes >= self.commit_every:
+				self.sync()
+
+	def load(self, uri):
+		with self.lock:
+			row = self.conn.execute("SELECT type, headers, json FROM objects WHERE uri=?",
+				(uri,)).fetchone()
+		if row is None:
+			raise KeyError(uri)
+		typ, hdrs, js = row
+		return self.rehydrate(uri, typ, json.loads(hdrs), json.loads(js))
+
+	def rehydrate(self, uri, typ, hdrs, js):
+		rdr = self.reader
+		cls = rdr.find_class([typ])
+		if cls is None:
+			cls = NonRDFSource if typ == NonRDFSource._type else RDFSource
+		what = cls(uri)
+		what.context = rdr.context
+		what.etag = hdrs['etag']
+		what.lastModified = hdrs['last-modified']
+		what.link_header = hdrs['link']
+		what.links = parse_link_header(what.link_header)
+		what.contentType = hdrs['content-type']
+		if isinstance(what, RDFSource):
+			what.json = js
+		# live before relationships are rebuilt, to break cycles
+		self.cache_put(uri, what)
+		if isinstance(what, NonRDFSource):
+			dby = what.links['describedby'][0]
+			what.describedby = rdr.retrieve(dby, instance=RDFSource(uri=dby), target=uri)
+		else:
+			what.build_from_rdf(rdr)
+		return what
+
+	def __setitem__(self, uri, what):
+		self.cache_put(uri, what)
+		self.save(what)
+
+	def __getitem__(self, uri):
+		with self.lock:
+			if self.cache.has_key(uri):
+				what = self.cache.pop(uri)
+				self.cache[uri] = what
+				return what
+			what = self.live.get(uri)
+		if what is not None:
+			self.cache_put(uri, what)
+			return what
+		return self.load(uri)
+
+	def __delitem__(self, uri):
+		with self.lock:
+			self.cache.pop(uri, None)
+			self.live.pop(uri, None)
+			self.conn.execute("DELETE FROM objects WHERE uri=?", (uri,))
+			self.conn.commit()
+
+	def __contains__(self, uri):
+		return self.has_key(uri)
+
+	def __len__(self):
+		with self.lock:
+			return self.conn.execute("SELECT COUNT(*) FROM objects").fetchone()[0]
+
+	def has_key(self, uri):
+		with self.lock:
+			if self.cache.has_key(uri) or self.live.has_key(uri):
+				return True
+			return self.conn.execute("SELECT 1 FROM objects WHERE uri=?", (uri,)).fetchone() is not None
+
+	def get(self, uri, default=None):
+		try:
+			return self[uri]
+		except KeyError:
+			return default
+
+	def keys(self):
+		with self.lock:
+			return [r[0] for r in self.conn.execute("SELECT uri FROM objects")]
+
+	def itervalues(self):
+		for uri in self.keys():
+			yield self[uri]
+
+	def values(self):
+		return list(self.itervalues())
+
+	def clear(self):
+		with self.lock:
+			self.cache.clear()
+			self.live.clear()
+			self.conn.execute("DELETE FROM objects")
+			self.conn.commit()
@@ -0,0 +1,142 @@
+import json
+import os
+
+import requests
+
+from ldp import NonRDFSource, RDFSource, parse_link_header
+
+# Incremental mirror of a repository subtree
+# State from the previous run is kept in a JSON file, keyed by URI:
+#   {uri: {"etag": ..., "modified": ..., "metadata": ..., "type": ..., "contains": [...]}}
+# metadata is the ETag of a binary's fcr:metadata description
+# Only resources whose ETag/Last-Modified differ are fetched again
+
+class LDPSync(object):
+
+	def __init__(self, reader, statefile=""):
+		self.reader = reader
+		self.statefile = statefile
+		self.state = {}
+		self.feed = []
+		if statefile and os.path.exists(statefile):
+			self.load()
+
+	def load(self):
+		fh = file(self.statefile)
+		self.state = json.load(fh)
+		fh.close()
+
+	def save(self):
+		if not self.statefile:
+			raise ValueError()
+		tmp = self.statefile + ".tmp"
+		fh = file(tmp, 'w')
+		json.dump(self.state, fh)
+		fh.close()
+		os.rename(tmp, self.statefile)
+
+	def get_types(self, js):
+		types = js.get('@type', js.get(self.reader.context.type_alias, []))
+		if type(types) != list:
+			types = [types]
+		return types
+
+	def get_type(self, js, binary=False):
+		types = self.get_types(js)
+		if binary:
+			# Report pcdm:File for binaries described as such
+			norm = self.reader.normalize_type
+			if norm('pcdm:File') in [norm(t) for t in types]:
+				return 'pcdm:File'
+			return NonRDFSource._type
+		cls = self.reader.find_class(types)
+		return cls._type if cls else RDFSource._type
+
+	def get_contains(self, js):
+		contains = js.get('contains', [])
+		if type(contains) != list:
+			contains = [contains]
+		return [self.reader.get_uri(c) for c in contains]
+
+	def head(self, uri):
+		# None if it has gone
+		req = requests.head(url=uri, headers=self.reader.ldp_headers_get)
+		if req.status_code in [404, 410]:
+			return None
+		req.raise_for_status()
+		return req.headers
+
+	def get_metadata_etag(self, hdrs):
+		# Binaries also change when their description does
+		if self.reader.is_rdf_type(hdrs.get('content-type', '')):
+			return ''
+		dby = parse_link_header(hdrs.get('link', '')).get('describedby', [])
+		mhdrs = self.head(dby[0]) if dby else None
+		return mhdrs.get('etag', '') if mhdrs else ''
+
+	def fetch(self, uri, hdrs):
+		# Just this resource's description, rather than retrieve, which
+		# would also build everything it refers to
+		# -> (type, contains)
+		rdr = self.reader
+		if rdr.is_rdf_type(hdrs.get('content-type', '')):
+			js = rdr.parse_response(rdr.fetch(uri), uri)
+			return (self.get_type(js), self.get_contains(js))
+		dby = parse_link_header(hdrs.get('link', '')).get('describedby', [])
+		js = rdr.parse_response(rdr.fetch(dby[0]), uri) if dby else {}
+		return (self.get_type(js, binary=True), [])
+
+	def add_change(self, action, uri, typ):
+		self.feed.append({'action': action, 'uri': uri, 'type': typ})
+
+	def sync(self, uri):
+		# Returns the change feed for the subtree rooted at uri
+		self.feed = []
+		seen = set()
+		todo = [uri]
+
+		while todo:
+			curr = todo.pop()
+			if curr in seen:
+				continue
+			seen.add(curr)
+
+			prev = self.state.get(curr)
+			hdrs = self.head(curr)
+			if hdrs is None:
+				# deleted during the run, so reported as removed below
+				seen.discard(curr)
+				continue
+			etag = hdrs.get('etag', '')
+			modified = hdrs.get('last-modified', '')
+			metadata = self.get_metadata_etag(hdrs)
+			if prev and prev['etag'] == etag and prev['modified'] == modified \
+					and prev.get('metadata', '') == metadata:
+				# unchanged, so trust previous containment
+				contains = prev['contains']
+			else:
+				typ, contains = self.fetch(curr, hdrs)
+				self.state[curr] = {'etag': etag, 'modified': modified,
+					'metadata': metadata, 'type': typ, 'contains': contains}
+				self.add_change('updated' if prev else 'added', curr, typ)
+
+			for c in contains:
+				if not c in seen:
+					todo.append(c)
+
+		# Anything we knew about in this subtree that wasn't reached is gone
+		# NB /rest/c2 is not inside /rest/c
+		base = uri.rstrip('/') + '/'
+		for old in self.state.keys():
+			if (old == uri or old.startswith(base)) and not old in seen:
+				self.add_change('removed', old, self.state[old]['type'])
+				del self.state[old]
+
+		if self.statefile:
+			self.save()
+		return self.feed
+
+	def write_feed(self, fh):
+		# One JSON change record per line
+		for change in self.feed:
+			fh.write(json.dumps(change) + "\n")